@@ -1,37 +1,450 @@
 import argparse
-import json
-from json.decoder import JSONDecodeError
+from array import array
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import ctypes
+from datetime import datetime, timezone
+import errno
+from functools import cached_property, partial
+import hashlib
+import mmap
 import os
 from pathlib import Path
 from pathvalidate import sanitize_filepath
+import platform
 import plistlib
+import posixpath
 import pyprind
+import re
 import shutil
 import sqlite3
+from stat import S_ISREG
+import struct
 import sys
 from tabulate import tabulate
-from time import sleep
+import threading
+from time import monotonic, sleep
 from types import FunctionType
+from typing import Callable, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# A sorted array of 20-byte binary fileIDs, memory-mapped and binary-searched,
+# so presence checks cost a few bytes per file instead of a Python object each.
+class FileIDSet():
+    RECORD_SIZE = 20
+
+    path: Path = None
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.__map = None
+        self.__count = 0
+
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+
+            # Zero-length files cannot be mapped, and an empty set needs no lookups anyway.
+            if size > 0:
+                self.__map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.__count = size // FileIDSet.RECORD_SIZE
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def __contains__(self, fileID: str) -> bool:
+        try:
+            key = bytes.fromhex(fileID)
+        except ValueError:
+            return False
+
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * FileIDSet.RECORD_SIZE
+            record = self.__map[offset:offset + FileIDSet.RECORD_SIZE]
+
+            if record == key:
+                return True
+            elif record < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        return False
+
+    @staticmethod
+    def write(path: Path, fileIDs):
+        # Lowercase hex sorts the same way as the bytes it encodes,
+        # so fileIDs that are already in order can be streamed straight out.
+        temporary = path.with_name(path.name + '.tmp')
+
+        with open(temporary, 'wb') as file:
+            for fileID in fileIDs:
+                if len(fileID) != FileIDSet.RECORD_SIZE * 2:
+                    continue
+
+                try:
+                    file.write(bytes.fromhex(fileID))
+                except ValueError:
+                    continue
+
+        os.replace(temporary, path)
+
+# Columnar metadata decoded from the NSKeyedArchiver blobs in the 'file' column of Manifest.db.
+# Unknown values, e.g. from a missing or malformed blob, are stored as -1.
+class FileMetadata():
+    # The MBFile keys that are decoded, in column order.
+    KEYS = { b'Size': 0, b'LastModified': 1, b'Birth': 2, b'Mode': 3, b'ProtectionClass': 4 }
+    UNKNOWN = (-1, -1, -1, -1, -1)
+
+    TRAILER = struct.Struct('>6xBBQQQ')
+    WIDTHS = { 1: 'B', 2: 'H', 4: 'I', 8: 'Q' }
+
+    # Binary plist dates count seconds since 2001-01-01 UTC instead of the Unix epoch.
+    DATE_EPOCH = 978307200
+
+    __encoded_keys = {}
+
+    size: array = None
+    mtime: array = None
+    birth: array = None
+    mode: array = None
+    protection: array = None
+
+    def __init__(self):
+        self.size = array('q')
+        self.mtime = array('q')
+        self.birth = array('q')
+        self.mode = array('l')
+        self.protection = array('b')
+
+    def __len__(self) -> int:
+        return len(self.size)
+
+    def __getitem__(self, row: int) -> tuple:
+        return self.size[row], self.mtime[row], self.birth[row], self.mode[row], self.protection[row]
+
+    def append(self, blob: Optional[bytes]):
+        size, mtime, birth, mode, protection = FileMetadata.decode(blob)
+
+        self.size.append(size)
+        self.mtime.append(mtime)
+        self.birth.append(birth)
+        self.mode.append(mode)
+        self.protection.append(protection)
+
+    @staticmethod
+    def decode_batch(blobs) -> 'FileMetadata':
+        metadata = FileMetadata()
+        for blob in blobs:
+            metadata.append(blob)
+
+        return metadata
+
+    @staticmethod
+    def decode(blob: Optional[bytes]) -> tuple:
+        # Rather than building plistlib's full object graph, this locates the few key strings
+        # it needs with bytes.find and follows their references straight to the integer values.
+        if not blob or not blob.startswith(b'bplist00'):
+            return FileMetadata.UNKNOWN
+
+        try:
+            offset_size, ref_size, count, top, table = FileMetadata.TRAILER.unpack_from(blob, len(blob) - FileMetadata.TRAILER.size)
+            offsets = struct.unpack_from(f'>{count}{FileMetadata.WIDTHS[offset_size]}', blob, table)
+            ref_format = FileMetadata.WIDTHS[ref_size]
+
+            archive = FileMetadata.__dictionary__(blob, offsets, ref_format, top)
+            archive_top = FileMetadata.__dictionary__(blob, offsets, ref_format, archive[FileMetadata.__key__(blob, offsets, b'$top')])
+
+            # Follow $top.root (a UID) to its entry in $objects: the archived MBFile dictionary.
+            uid = offsets[archive_top[FileMetadata.__key__(blob, offsets, b'root')]]
+            root = int.from_bytes(blob[uid + 1:uid + 2 + (blob[uid] & 0xF)], 'big')
+
+            _, position = FileMetadata.__length__(blob, offsets[archive[FileMetadata.__key__(blob, offsets, b'$objects')]])
+            fields = FileMetadata.__dictionary__(blob, offsets, ref_format, struct.unpack_from(f'>{ref_format}', blob, position + root * ref_size)[0])
+
+            values = list(FileMetadata.UNKNOWN)
+            for name, column in FileMetadata.KEYS.items():
+                value = fields.get(FileMetadata.__key__(blob, offsets, name))
+                if value is None:
+                    continue
+
+                position = offsets[value]
+                marker, width = blob[position] >> 4, 1 << (blob[position] & 0xF)
+
+                if marker == 0x1:
+                    values[column] = int.from_bytes(blob[position + 1:position + 1 + width], 'big', signed=width >= 8)
+                elif marker == 0x2:
+                    values[column] = int(struct.unpack_from('>d' if width == 8 else '>f', blob, position + 1)[0])
+                elif marker == 0x3:
+                    values[column] = int(struct.unpack_from('>d', blob, position + 1)[0]) + FileMetadata.DATE_EPOCH
+
+            return tuple(values)
+        except (IndexError, KeyError, TypeError, ValueError, struct.error):
+            return FileMetadata.UNKNOWN
+
+    @staticmethod
+    def __key__(blob: bytes, offsets: tuple, name: bytes) -> Optional[int]:
+        # Returns the object number of the ASCII string `name`, or None if the blob does not contain it.
+        encoded = FileMetadata.__encoded_keys.get(name)
+        if encoded is None:
+            header = bytes([0x50 | len(name)]) if len(name) < 0xF else bytes([0x5F, 0x10, len(name)])
+            encoded = FileMetadata.__encoded_keys[name] = header + name
+
+        position = blob.find(encoded)
+        while position != -1:
+            # The same bytes may occur inside another object, so only an object's start counts.
+            if position in offsets:
+                return offsets.index(position)
+
+            position = blob.find(encoded, position + 1)
+
+        return None
+
+    @staticmethod
+    def __dictionary__(blob: bytes, offsets: tuple, ref_format: str, ref: int) -> dict:
+        # Maps the object numbers of a dictionary's keys to those of its values.
+        if blob[offsets[ref]] >> 4 != 0xD:
+            raise ValueError
+
+        count, position = FileMetadata.__length__(blob, offsets[ref])
+        refs = struct.unpack_from(f'>{2 * count}{ref_format}', blob, position)
+
+        return dict(zip(refs[:count], refs[count:]))
+
+    @staticmethod
+    def __length__(blob: bytes, position: int) -> tuple:
+        count = blob[position] & 0xF
+        position += 1
+
+        if count == 0xF and blob[position] >> 4 == 0x1:
+            width = 1 << (blob[position] & 0xF)
+            count = int.from_bytes(blob[position + 1:position + 1 + width], 'big')
+            position += 1 + width
+
+        return count, position
+
+class BackupIndex():
+    # Anything else in a shard directory, like a stray .DS_Store, is not part of the backup.
+    FILE_ID = re.compile(r'[0-9a-f]{40}')
+
+    path: Path = None
+    backup_path: Path = None
+
+    def __init__(self, path: Path, backup_path: Path):
+        self.path = path
+        self.backup_path = backup_path
+        self.__connection = None
+        self.__ids = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # Opened on first use, so a run that never consults the index never touches it.
+        if self.__connection is None:
+            self.__connection = sqlite3.connect(self.path, uri=True)
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS Files (fileID TEXT PRIMARY KEY, shard TEXT, size INTEGER, mtime REAL) WITHOUT ROWID;")
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS FilesByShard ON Files (shard);")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS Shards (shard TEXT PRIMARY KEY, mtime INTEGER) WITHOUT ROWID;")
+
+        return self.__connection
+
+    @property
+    def ids(self) -> FileIDSet:
+        if self.__ids is None:
+            self.__ids = FileIDSet(self.path.with_suffix('.ids'))
+
+        return self.__ids
+
+    def __contains__(self, fileID: str) -> bool:
+        return fileID in self.ids
+
+    def remove(self):
+        # Drops the index entirely, so that the next refresh rebuilds it from scratch.
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+        self.__ids = None
+
+        for path in (self.path, self.path.with_suffix('.ids')):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def locate(self, fileID: str) -> Optional[Path]:
+        # Only shard directories are indexed, so a known fileID always lives in its own shard.
+        return self.backup_path / fileID[:2] / fileID if fileID in self else None
+
+    def refresh(self, jobs: int = 32) -> int:
+        # Adding, removing or renaming a file bumps its shard directory's mtime,
+        # so only the shards whose mtime differs from the recorded one are rescanned.
+        known = dict(self.connection.execute("SELECT shard, mtime FROM Shards;"))
+        shards = [f'{shard:02x}' for shard in range(256)]
+        rescanned = 0
+
+        print("Refreshing backup index..." if known else "Parsing backup...")
+
+        # Each shard is listed by its own worker; on network mounts the
+        # directory round-trips dominate, so they are overlapped.
+        bar = pyprind.ProgBar(len(shards))
+        with self.connection, ThreadPoolExecutor(max_workers=jobs) as pool:
+            for shard, mtime, found in pool.map(partial(BackupIndex.__scan_shard__, self.backup_path, known), shards):
+                if found is not None:
+                    self.connection.execute("DELETE FROM Files WHERE shard = ?;", (shard,))
+                    self.connection.executemany("INSERT INTO Files VALUES (?, ?, ?, ?);", found)
+                    rescanned += 1
+
+                if mtime is None:
+                    self.connection.execute("DELETE FROM Shards WHERE shard = ?;", (shard,))
+                else:
+                    self.connection.execute("INSERT OR REPLACE INTO Shards VALUES (?, ?);", (shard, mtime))
+
+                bar.update()
+
+        ids_path = self.path.with_suffix('.ids')
+        if rescanned > 0 or not ids_path.is_file():
+            self.__ids = None
+            FileIDSet.write(ids_path, (row[0] for row in self.connection.execute("SELECT fileID FROM Files ORDER BY fileID;")))
+
+        return rescanned
+
+    def reconcile(self, manifest_path: Path) -> list:
+        # Both differences are computed inside SQLite as anti-joins against the attached
+        # manifest instead of probing the index once per Manifest.db row.
+        self.connection.execute("ATTACH DATABASE ? AS manifest;", (manifest_path.as_uri() + '?mode=ro',))
+
+        try:
+            present = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM manifest.Files m JOIN main.Files f ON f.fileID = m.fileID;"
+            ).fetchone()
+            # Sizes of missing files are only known from their Manifest.db metadata.
+            missing = FileMetadata.decode_batch(row[0] for row in self.connection.execute(
+                "SELECT m.file FROM manifest.Files m WHERE m.flags = 1 AND NOT EXISTS (SELECT 1 FROM main.Files f WHERE f.fileID = m.fileID);"
+            ))
+            orphaned = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM main.Files f WHERE NOT EXISTS (SELECT 1 FROM manifest.Files m WHERE m.fileID = f.fileID);"
+            ).fetchone()
+        finally:
+            self.connection.execute("DETACH DATABASE manifest;")
+
+        return [
+            ["Present", present[0], present[1]],
+            ["Missing from backup", len(missing), sum(size for size in missing.size if size > 0)],
+            ["Orphaned in backup", orphaned[0], orphaned[1]],
+        ]
+
+    @staticmethod
+    def __scan_shard__(backup_path: Path, known: dict, shard: str) -> tuple:
+        try:
+            mtime = os.stat(backup_path / shard).st_mtime_ns
+        except FileNotFoundError:
+            # A shard that was indexed before but is gone now still needs its rows dropped.
+            return shard, None, [] if shard in known else None
+
+        if known.get(shard) == mtime:
+            return shard, mtime, None
+
+        found = []
+
+        with os.scandir(backup_path / shard) as entries:
+            for entry in entries:
+                # DirEntry carries the type from the directory listing, so no extra stat is needed.
+                if entry.is_file() and entry.name.startswith(shard) and BackupIndex.FILE_ID.fullmatch(entry.name):
+                    stat = entry.stat()
+                    found.append((entry.name, shard, stat.st_size, stat.st_mtime))
+
+        return shard, mtime, found
 
 class ParsedBackup():
     path: Path = None
-    found_files: dict = {}
-    files: sqlite3.Cursor = None
+    index: Optional[BackupIndex] = None
+    profile: str = 'immutable'
+    cache_path: Path = None
+
+    # How Manifest.db is opened. 'immutable' never writes to or locks the backup,
+    # and lets large manifests be served from memory-mapped pages and a big page cache.
+    # 'memory' copies it into an in-memory database and indexes the columns extractors filter on,
+    # which pays for itself as soon as more than one extractor runs.
+    CONNECTION_PROFILES = {
+        'standard': { 'parameters': '', 'pragmas': {} },
+        'immutable': { 'parameters': 'mode=ro&immutable=1', 'pragmas': { 'mmap_size': 1 << 30, 'cache_size': -256 * 1024 } },
+        'memory': { 'parameters': 'mode=ro&immutable=1', 'pragmas': {}, 'in_memory': True },
+    }
 
-    info: dict = {}
-    manifest: dict = {}
-    status: dict = {}
+    # LIKE is case-insensitive and GLOB is not, so relativePath is indexed
+    # with both collations for prefix patterns of either kind to use an index.
+    MEMORY_INDEXES = [
+        "CREATE INDEX FilesByDomain ON Files (domain);",
+        "CREATE INDEX FilesByRelativePath ON Files (relativePath);",
+        "CREATE INDEX FilesByRelativePathNoCase ON Files (relativePath COLLATE NOCASE);",
+        "CREATE INDEX FilesByFlags ON Files (flags);",
+    ]
 
-    def __init__(self, path: Path, found_files: dict):
+    def __init__(self, path: Path, index: Optional[BackupIndex] = None, profile: str = 'immutable', cache_path: Path = None):
         self.path = path
-        self.found_files = found_files
+        self.index = index
+        self.profile = profile
+        self.cache_path = cache_path or ParsedBackup.default_cache_path()
+
+    # Each part of the backup is only read the first time it is needed:
+    # Info.plist in particular can be several MB of embedded icons and iTunes data.
+    @cached_property
+    def info(self) -> dict:
+        return self.__parse_plist__(self.path / 'Info.plist')
+
+    @cached_property
+    def manifest(self) -> dict:
+        return self.__parse_plist__(self.path / 'Manifest.plist')
+
+    @cached_property
+    def status(self) -> dict:
+        return self.__parse_plist__(self.path / 'Status.plist')
+
+    @cached_property
+    def connection(self) -> sqlite3.Connection:
+        profile = ParsedBackup.CONNECTION_PROFILES[self.profile]
+        uri = (self.path / 'Manifest.db').as_uri()
+
+        if profile['parameters']:
+            uri += '?' + profile['parameters']
+
+        connection = sqlite3.connect(uri, uri=True)
+        for pragma, value in profile['pragmas'].items():
+            connection.execute(f"PRAGMA {pragma} = {value};")
+
+        if profile.get('in_memory'):
+            print("Loading Manifest.db into memory...")
 
-        self.info = self.__parse_plist__(path / 'Info.plist')
-        self.manifest = self.__parse_plist__(path / 'Manifest.plist')
-        self.status = self.__parse_plist__(path / 'Status.plist')
+            snapshot = sqlite3.connect(':memory:')
+            connection.backup(snapshot)
+            connection.close()
 
-        con = sqlite3.connect(path / 'Manifest.db')
-        self.files = con.cursor()
+            with snapshot:
+                for statement in ParsedBackup.MEMORY_INDEXES:
+                    snapshot.execute(statement)
+
+            connection = snapshot
+
+        return connection
+
+    def count(self, where: str = '', params: tuple = ()) -> int:
+        return self.connection.execute(f"SELECT COUNT(*) FROM Files {where};", params).fetchone()[0]
+
+    def select(self, columns: tuple, where: str = '', params: tuple = (), batch_size: int = 1000, order: str = '') -> Iterator[list]:
+        # Only the requested columns are read: the serialized 'file' column is
+        # by far the largest one, and most callers never look at it.
+        #
+        # Rows are handed out in batches as SQLite produces them, so memory stays bounded
+        # and callers can start working before the whole query has been evaluated.
+        cursor = self.connection.execute(f"SELECT {', '.join(columns)} FROM Files {where} {order};", params)
+
+        while batch := cursor.fetchmany(batch_size):
+            yield batch
 
     def pretty_print_information(self):
         print(tabulate(
@@ -44,35 +457,112 @@ class ParsedBackup():
             ]
         ))
 
-    @staticmethod
-    def from_path(backup_path: Path):
-        json_file = backup_path / 'pybackup.json'
-        json_data = {}
+    def pretty_print_reconciliation(self):
+        if self.index is None:
+            raise ValueError("Reconciling a backup requires it to be indexed with '--resolver scan'.")
 
-        if not json_file.is_file():
-            print("Parsing backup...")
-            files = list(backup_path.rglob('*'))
-            file_count = len(files)
+        print(tabulate(
+            [[name, count, format_size(size)] for name, count, size in self.index.reconcile(self.path / 'Manifest.db')],
+            headers=["", "Files", "Size"]
+        ))
 
-            bar = pyprind.ProgBar(file_count)
-            for file in files:
-                if not file.is_dir():
-                    json_data[file.name] = { 'path': os.path.relpath(file, backup_path) }
-                bar.update()
+    def pretty_print_statistics(self, domain: str = ''):
+        rows = self.statistics(domain)
+
+        print(tabulate(
+            [[name, count, format_size(size), '' if newest < 0 else datetime.fromtimestamp(newest, timezone.utc).strftime("%Y-%m-%d %H:%M")] for name, count, size, newest in rows],
+            headers=["Directory" if domain else "Domain", "Files", "Size", "Newest"]
+        ))
+
+    def statistics(self, domain: str = '') -> list:
+        # Per-directory totals are computed once per backup and cached; per-domain
+        # totals are summed from them, so either view is a quick query afterwards.
+        connection = sqlite3.connect(self.cache_file('.stats.db'))
+
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS Statistics (domain TEXT, directory TEXT, files INTEGER, size INTEGER, newest INTEGER, PRIMARY KEY (domain, directory)) WITHOUT ROWID;")
 
-            with open(json_file, 'w') as file:
-                file.write(json.dumps(json_data))
-                file.close()
+            if connection.execute("SELECT 1 FROM Statistics LIMIT 1;").fetchone() is None:
+                connection.executemany("INSERT INTO Statistics VALUES (?, ?, ?, ?, ?);", self.__aggregate__())
+
+        if domain:
+            rows = connection.execute("SELECT directory, files, size, newest FROM Statistics WHERE domain = ? ORDER BY size DESC;", (domain,)).fetchall()
         else:
-            with open(json_file, 'r') as file:
-                try:
-                    json_data = json.load(file)
-                except JSONDecodeError:
-                    print(f"There was an error decoding the JSON file at {json_file}. Please delete it and re-parse the backup.")
+            rows = connection.execute("SELECT domain, SUM(files), SUM(size), MAX(newest) FROM Statistics GROUP BY domain ORDER BY 3 DESC;").fetchall()
+
+        connection.close()
+        return rows
+
+    def __aggregate__(self) -> list:
+        print("Computing statistics...")
+
+        totals = {}
+        bar = pyprind.ProgBar(self.count('WHERE flags = 1'))
+        for batch in self.select(('domain', 'relativePath', 'file'), 'WHERE flags = 1'):
+            metadata = FileMetadata.decode_batch(file[2] for file in batch)
+
+            for row, (domain, relativePath, _) in enumerate(batch):
+                key = (domain, posixpath.dirname(relativePath))
+                total = totals.get(key)
+                if total is None:
+                    total = totals[key] = [0, 0, -1]
+
+                total[0] += 1
+                total[1] += max(metadata.size[row], 0)
+                total[2] = max(total[2], metadata.mtime[row])
+                bar.update()
 
-                file.close()
+        return [(domain, directory, *total) for (domain, directory), total in totals.items()]
+
+    @property
+    def udid(self) -> str:
+        return (self.info.get('Unique Identifier') or self.info['Target Identifier']).lower()
+
+    @property
+    def cache_key(self) -> str:
+        # The same backup keeps its UDID and date wherever it is mounted,
+        # so anything cached under this key is reused across paths.
+        return f"{self.udid}-{self.status['Date'].strftime('%Y%m%dT%H%M%SZ')}"
+
+    def cache_file(self, suffix: str, key: Optional[str] = None) -> Path:
+        # Cached data lives outside of the backup so that read-only archives can be processed.
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        return self.cache_path / f'{key or self.cache_key}{suffix}'
+
+    def locate(self, fileID: str) -> Optional[Path]:
+        # Without an inventory, the location is derived from the fileID itself:
+        # every file is stored at <first two hex chars of fileID>/<fileID>.
+        if self.index is None:
+            source = self.path / fileID[:2] / fileID
+            return source if source.is_file() else None
+
+        return self.index.locate(fileID)
+
+    @staticmethod
+    def from_path(backup_path: Path, resolver: str = 'hash', cache_path: Path = None, profile: str = 'immutable', jobs: int = 32):
+        backup = ParsedBackup(backup_path, profile=profile, cache_path=cache_path)
+
+        if resolver == 'hash':
+            return backup
+
+        # Updating a backup in place changes its date, but the index only needs the
+        # shards that changed rescanned, so it is kept per device rather than per date.
+        index = BackupIndex(backup.cache_file('.db', backup.udid), backup_path)
+
+        # A damaged index is rebuilt once; if that fails as well, the error is not hidden.
+        try:
+            index.refresh(jobs)
+        except sqlite3.DatabaseError as error:
+            print(f"There was an error reading the index at {index.path} ({error}). Re-parsing the backup...")
+            index.remove()
+            index.refresh(jobs)
 
-        return ParsedBackup(backup_path, json_data)
+        backup.index = index
+        return backup
+
+    @staticmethod
+    def default_cache_path() -> Path:
+        return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'pybackup'
 
     @staticmethod
     def __parse_plist__(path: Path) -> dict:
@@ -84,6 +574,648 @@ class ParsedBackup():
 
         return data
 
+def format_size(size: int) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if size < 1024 or unit == 'TB':
+            break
+        size /= 1024
+
+    return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+
+def parse_size(size: str) -> int:
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', size, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"'{size}' is not a valid size!")
+
+    return int(float(match[1]) * 1024 ** ' KMGT'.index(match[2].upper() or ' '))
+
+# A selection of Manifest.db rows built from expressions such as 'domain=CameraRollDomain',
+# 'domain^=AppDomain-', 'path=Media/DCIM/*', 'ext=jpg,heic', 'size>=1M' or 'mtime<2021-06-01'.
+# Everything Manifest.db can answer itself is compiled into the WHERE clause; only size and
+# mtime need the decoded Files.file metadata and are checked as rows arrive.
+class Filter():
+    EXPRESSION = re.compile(r'\s*(domain|path|ext|size|mtime)\s*(\^=|>=|<=|=|>|<)\s*(.+?)\s*')
+    COMPARISONS = {
+        '=': lambda value, bound: value == bound,
+        '>': lambda value, bound: value > bound,
+        '<': lambda value, bound: value < bound,
+        '>=': lambda value, bound: value >= bound,
+        '<=': lambda value, bound: value <= bound,
+    }
+
+    clauses: list = None
+    params: list = None
+    predicates: list = None
+
+    def __init__(self):
+        self.clauses = []
+        self.params = []
+        self.predicates = []
+
+    def where(self, *conditions: str) -> str:
+        clauses = list(conditions) + self.clauses
+        return f"WHERE {' AND '.join(clauses)}" if clauses else ''
+
+    def matches(self, metadata: tuple) -> bool:
+        for column, comparison, bound in self.predicates:
+            # Unknown metadata never satisfies a bound.
+            if metadata[column] < 0 or not comparison(metadata[column], bound):
+                return False
+
+        return True
+
+    @staticmethod
+    def parse(expressions: list[str]) -> 'Filter':
+        selection = Filter()
+
+        for expression in expressions:
+            match = Filter.EXPRESSION.fullmatch(expression)
+            if match is None:
+                raise ValueError(f"'{expression}' is not a valid filter expression!")
+
+            field, operator, value = match.groups()
+
+            if field in ('size', 'mtime'):
+                if operator == '^=':
+                    raise ValueError(f"'{expression}': {field} can only be compared with =, <, >, <= or >=.")
+
+                bound = parse_size(value) if field == 'size' else Filter.__parse_time__(value)
+                selection.predicates.append((0 if field == 'size' else 1, Filter.COMPARISONS[operator], bound))
+            elif operator not in ('=', '^='):
+                raise ValueError(f"'{expression}': {field} can only be matched with = or ^=.")
+            elif field == 'domain' and operator == '=':
+                selection.clauses.append("domain = ?")
+                selection.params.append(value)
+            elif field == 'domain' or field == 'path':
+                # GLOB is case-sensitive like the paths themselves, and a literal prefix lets SQLite use an index.
+                column = 'domain' if field == 'domain' else 'relativePath'
+                selection.clauses.append(f"{column} GLOB ?")
+                selection.params.append(Filter.__escape_glob__(value) + '*' if operator == '^=' else value)
+            else:
+                if operator != '=':
+                    raise ValueError(f"'{expression}': ext can only be matched with =.")
+
+                extensions = [extension.strip().lstrip('.') for extension in value.split(',')]
+                extensions = [extension for extension in extensions if extension]
+                if not extensions:
+                    raise ValueError(f"'{expression}' is not a valid filter expression!")
+
+                # '%' and '_' are LIKE wildcards, so they are escaped within the extensions themselves.
+                condition = "relativePath LIKE ? ESCAPE '\\'"
+                selection.clauses.append(f"({' OR '.join([condition] * len(extensions))})")
+                selection.params.extend('%.' + Filter.__escape_like__(extension) for extension in extensions)
+
+        return selection
+
+    @staticmethod
+    def __escape_glob__(value: str) -> str:
+        return re.sub(r'([*?\[])', r'[\1]', value)
+
+    @staticmethod
+    def __escape_like__(value: str) -> str:
+        return re.sub(r'([%_\\])', r'\\\1', value)
+
+    @staticmethod
+    def __parse_time__(value: str) -> int:
+        try:
+            time = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"'{value}' is not a valid date!")
+
+        # Dates without a timezone are taken to be UTC, like the backup's own timestamps.
+        return int((time if time.tzinfo else time.replace(tzinfo=timezone.utc)).timestamp())
+
+# A content-addressed store: every distinct file content is kept once, at <digest[:2]>/<digest>.
+# Digests are remembered per fileID, size and mtime, so files that have not changed since an
+# earlier extraction are not read again just to find out that their content is already stored.
+class ContentStore():
+    LAYOUTS = ['hardlink', 'manifest']
+
+    path: Path = None
+    layout: str = 'hardlink'
+
+    def __init__(self, path: Path, layout: str = 'hardlink'):
+        self.path = path
+        self.layout = layout
+
+        path.mkdir(parents=True, exist_ok=True)
+
+        # Workers share the connection, so every use of it is serialized.
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path / 'digests.db', check_same_thread=False)
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS Digests (fileID TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT) WITHOUT ROWID;")
+
+    def blob(self, digest: str) -> Path:
+        return self.path / digest[:2] / digest
+
+    def digest(self, fileID: str, source: Path, source_stat: os.stat_result, throttle: Callable) -> str:
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT digest FROM Digests WHERE fileID = ? AND size = ? AND mtime = ?;", (fileID, source_stat.st_size, source_stat.st_mtime_ns)
+            ).fetchone()
+
+        if row is not None:
+            return row[0]
+
+        digest = hashlib.sha256()
+        with open(source, 'rb') as file:
+            while chunk := file.read(CopyEngine.BUFFER_SIZE):
+                throttle(len(chunk))
+                digest.update(chunk)
+
+        with self.__lock:
+            self.__connection.execute("INSERT OR REPLACE INTO Digests VALUES (?, ?, ?, ?);", (fileID, source_stat.st_size, source_stat.st_mtime_ns, digest.hexdigest()))
+
+        return digest.hexdigest()
+
+    def close(self):
+        with self.__lock:
+            self.__connection.commit()
+            self.__connection.close()
+
+# Copies files on a pool of worker threads. At most `queue_size` copies are in flight,
+# so the tasks iterator is only consumed as fast as the workers keep up with it.
+class CopyEngine():
+    # Data is copied with the first strategy that works, from cheapest to most expensive:
+    # a reflink shares the source's blocks, copy_file_range and sendfile stay in the kernel.
+    STRATEGIES = ['reflink', 'copy_file_range', 'sendfile', 'buffered']
+
+    # Errors meaning a strategy cannot work here at all, as opposed to failing for one file.
+    # Anything else (EXDEV across mounts, EINVAL for an unsupported file, ...) only falls
+    # through to the next strategy for the file at hand.
+    UNSUPPORTED_ERRORS = { errno.ENOSYS, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOTTY }
+
+    FICLONE = 0x40049409
+    PARTIAL_SUFFIX = '.pybackup-part'
+    RESTORE_BATCH = 256
+
+    IOPRIO_WHO_PROCESS = 1
+    IOPRIO_CLASSES = { 'realtime': 1, 'best-effort': 2, 'idle': 3 }
+    IOPRIO_SET_SYSCALLS = { 'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273, 'riscv64': 30 }
+    BUFFER_SIZE = 1024 * 1024
+
+    # 'hardlink' and 'symlink' only create links into the backup, so no data is copied at all.
+    LINK_MODES = ['copy', 'hardlink', 'symlink']
+
+    # The order files are read from the backup in. 'manifest' keeps Manifest.db's order, 'shard' walks
+    # the shard directories in turn, and 'inode' and 'extent' additionally sort each batch by inode
+    # or by the physical location of its first extent, to keep reads from spinning disks sequential.
+    ORDERS = ['manifest', 'shard', 'inode', 'extent']
+
+    FS_IOC_FIEMAP = 0xC020660B
+    FIEMAP_REQUEST = struct.Struct('=QQIIII')
+
+    jobs: int = 8
+    queue_size: int = 32
+    link_mode: str = 'copy'
+    order: str = 'manifest'
+    resume: bool = False
+    sync: bool = False
+    prune: bool = False
+    store: Optional['ContentStore'] = None
+    preserve: bool = False
+    bandwidth: Optional['TokenBucket'] = None
+    iops: Optional['TokenBucket'] = None
+    nice: Optional[int] = None
+    ioprio: Optional[tuple] = None
+
+    def __init__(self, jobs: int = 8, queue_size: int = None, link_mode: str = 'copy', order: str = 'manifest', resume: bool = False, sync: bool = False, prune: bool = False, store: Optional['ContentStore'] = None, preserve: bool = False,
+                 bandwidth: Optional['TokenBucket'] = None, iops: Optional['TokenBucket'] = None, nice: Optional[int] = None, ioprio: Optional[tuple] = None):
+        self.jobs = jobs
+        self.queue_size = queue_size or jobs * 4
+        self.link_mode = link_mode
+        self.order = order
+        self.resume = resume
+        self.sync = sync
+        self.prune = prune
+        self.store = store
+        self.preserve = preserve
+        self.bandwidth = bandwidth
+        self.iops = iops
+        self.nice = nice
+        self.ioprio = ioprio
+
+        # Every destination the selected files map to, so that pruning can tell which files to keep.
+        self.expected = set()
+
+        # A strategy that fails because the platform or filesystem lacks it is not retried for later files.
+        self.__unsupported = set()
+
+    def run(self, tasks: Iterator[tuple], on_complete: Callable) -> Counter:
+        # Tasks are (fileID, source, destination, metadata) tuples, where metadata is a decoded
+        # FileMetadata row or None; `on_complete` is called with the task, the strategy used,
+        # the source's stat and, when extracting into a content store, the digest once it has been extracted.
+        pending = {}
+        results = Counter()
+
+        # With `preserve` (or `sync`, for mtimes only), the original metadata of copied files
+        # is restored in batches that run on the same pool, in between the copies still in flight.
+        restorations = []
+        restoring = []
+
+        def complete(done: set):
+            # Results are collected on the calling thread, so `on_complete` needs no locking;
+            # result() also re-raises anything that went wrong in a worker.
+            for future in done:
+                task = pending.pop(future)
+                strategy, stat, digest = future.result()
+                results[strategy] += 1
+
+                if self.__restorable__(task, strategy):
+                    # '--sync' needs the original mtimes to recognize the copy later; permissions only change with '--preserve'.
+                    restorations.append((task[2], task[3][1], task[3][3] if self.preserve else -1))
+
+                if len(restorations) >= CopyEngine.RESTORE_BATCH:
+                    restoring.append(pool.submit(CopyEngine.__restore__, restorations.copy()))
+                    restorations.clear()
+
+                on_complete(task, strategy, stat, digest)
+
+        with ThreadPoolExecutor(max_workers=self.jobs, initializer=self.__initialize_worker__) as pool:
+            for task in tasks:
+                if len(pending) >= self.queue_size:
+                    complete(wait(pending, return_when=FIRST_COMPLETED)[0])
+
+                pending[pool.submit(self.__execute__, task)] = task
+
+            complete(wait(pending)[0])
+
+            if restorations:
+                restoring.append(pool.submit(CopyEngine.__restore__, restorations))
+
+            for future in restoring:
+                future.result()
+
+        return results
+
+    def __restorable__(self, task: tuple, strategy: str) -> bool:
+        # Only fresh copies are touched: links, unchanged files and store blobs share
+        # their inode with the backup or other paths, and must be left as they are.
+        return (self.preserve or self.sync) and self.store is None and task[3] is not None and strategy in CopyEngine.STRATEGIES
+
+    @staticmethod
+    def __restore__(restorations: list):
+        for destination, mtime, mode in restorations:
+            # Setuid and setgid bits come from metadata anyone can craft, so only
+            # the permission bits and the sticky bit are taken over.
+            if mode >= 0:
+                os.chmod(destination, mode & 0o1777)
+
+            if mtime >= 0:
+                os.utime(destination, (mtime, mtime))
+
+    @property
+    def needs_metadata(self) -> bool:
+        return self.sync or self.preserve
+
+    def sort(self, tasks: list) -> list:
+        if self.order in ('inode', 'extent'):
+            tasks.sort(key=lambda task: self.__location__(task[1]))
+
+        return tasks
+
+    def __location__(self, source: Path) -> tuple:
+        stat = os.stat(source)
+        extent = 0
+
+        if self.order == 'extent' and fcntl is not None and 'fiemap' not in self.__unsupported:
+            try:
+                extent = CopyEngine.__first_extent__(source)
+            except OSError as error:
+                if error.errno in CopyEngine.UNSUPPORTED_ERRORS:
+                    self.__unsupported.add('fiemap')
+
+        return stat.st_dev, extent, stat.st_ino
+
+    @staticmethod
+    def __first_extent__(source: Path) -> int:
+        # Asks FIEMAP for a single extent: struct fiemap is followed by one 56-byte struct fiemap_extent,
+        # whose fe_physical field is the second 64-bit value.
+        request = bytearray(CopyEngine.FIEMAP_REQUEST.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(56))
+
+        descriptor = os.open(source, os.O_RDONLY)
+        try:
+            fcntl.ioctl(descriptor, CopyEngine.FS_IOC_FIEMAP, request, True)
+        finally:
+            os.close(descriptor)
+
+        mapped = struct.unpack_from('=I', request, 20)[0]
+        return struct.unpack_from('=Q', request, CopyEngine.FIEMAP_REQUEST.size + 8)[0] if mapped else 0
+
+    def __execute__(self, task: tuple) -> tuple:
+        fileID, source, destination, metadata = task
+
+        if self.sync and self.__unchanged__(source, destination, metadata):
+            return 'unchanged', os.stat(source), None
+
+        if self.store is not None:
+            return self.__store__(fileID, source, destination)
+
+        strategy = self.transfer(source, destination)
+        return strategy, os.stat(source), None
+
+    def __store__(self, fileID: str, source: Path, destination: Path) -> tuple:
+        # Contents are kept once in the store under their digest; the destination only gets a hardlink
+        # to them, or nothing at all with the 'manifest' layout, which records the digest instead.
+        source_stat = os.stat(source)
+        digest = self.store.digest(fileID, source, source_stat, self.throttle)
+        blob = self.store.blob(digest)
+        strategy = 'deduplicated'
+
+        if not blob.is_file():
+            os.makedirs(blob.parent, exist_ok=True)
+            strategy = self.__copy__(source, blob)
+
+        if self.store.layout == 'hardlink':
+            try:
+                self.__link__(os.link, blob, destination)
+            except OSError as error:
+                if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+
+                self.__copy__(blob, destination)
+
+        return strategy, source_stat, digest
+
+    def __unchanged__(self, source: Path, destination: Path, metadata: Optional[tuple]) -> bool:
+        try:
+            existing = os.lstat(destination)
+        except FileNotFoundError:
+            return False
+
+        if self.link_mode == 'symlink':
+            return os.path.islink(destination) and os.readlink(destination) == str(source)
+
+        if self.link_mode == 'hardlink' and os.path.samestat(existing, os.stat(source)):
+            return True
+
+        # A copy is current if it has the size and mtime Manifest.db records, which copies made
+        # with '--sync' are given after writing them; unknown metadata always counts as changed.
+        size, mtime = (metadata[0], metadata[1]) if metadata is not None else (-1, -1)
+        return S_ISREG(existing.st_mode) and size >= 0 and mtime >= 0 and existing.st_size == size and int(existing.st_mtime) == mtime
+
+    def transfer(self, source: Path, destination: Path) -> str:
+        # The destination's directory is expected to exist already, see Extractors.__copy_tasks__.
+        if self.link_mode == 'symlink':
+            self.__link__(os.symlink, source, destination)
+            return 'symlink'
+
+        if self.link_mode == 'hardlink':
+            try:
+                self.__link__(os.link, source, destination)
+                return 'hardlink'
+            except OSError as error:
+                # Hardlinks cannot cross filesystems (or are refused on some), so those files are copied instead.
+                if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+
+        return self.__copy__(source, destination)
+
+    def __copy__(self, source: Path, destination: Path) -> str:
+        # Data is written under a temporary name and renamed into place when complete,
+        # so an interrupted run never leaves a truncated file behind under the real name.
+        # The name is unique per thread, as two workers may store the same content at once.
+        partial = CopyEngine.__partial__(destination)
+
+        # A leftover partial may be a link into the backup; writing through it would modify the backup.
+        CopyEngine.__remove__(partial)
+
+        try:
+            with open(source, 'rb') as input, open(partial, 'wb') as output:
+                strategy = self.__copy_data__(input, output)
+
+            shutil.copymode(source, partial)
+            os.replace(partial, destination)
+        except BaseException:
+            CopyEngine.__remove__(partial)
+            raise
+
+        return strategy
+
+    def __link__(self, link: Callable, target: Path, destination: Path):
+        # Links are created under the temporary name as well and renamed over whatever is at the
+        # destination: rename replaces an old link instead of writing through it, and unlike
+        # unlinking first it cannot race with another worker creating the same name.
+        partial = CopyEngine.__partial__(destination)
+        CopyEngine.__remove__(partial)
+        self.throttle(0)
+        link(target, partial)
+
+        try:
+            os.replace(partial, destination)
+        finally:
+            # Renaming a hardlink onto another link to the same file does nothing, leaving the partial behind.
+            CopyEngine.__remove__(partial)
+
+    @staticmethod
+    def __partial__(destination: Path) -> Path:
+        return destination.with_name(f'{destination.name}.{threading.get_ident()}{CopyEngine.PARTIAL_SUFFIX}')
+
+    @staticmethod
+    def __remove__(path: Path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def __copy_data__(self, input, output) -> str:
+        size = os.fstat(input.fileno()).st_size
+
+        for strategy in CopyEngine.STRATEGIES:
+            if strategy in self.__unsupported:
+                continue
+
+            try:
+                if strategy == 'reflink':
+                    if fcntl is None:
+                        raise OSError(errno.ENOTSUP, "fcntl is not available")
+
+                    # A reflink moves no data, so it only counts as a single operation.
+                    self.throttle(0)
+                    fcntl.ioctl(output.fileno(), CopyEngine.FICLONE, input.fileno())
+                elif strategy == 'copy_file_range':
+                    if not hasattr(os, 'copy_file_range'):
+                        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+
+                    self.__throttle_chunks__(lambda offset, count: os.copy_file_range(input.fileno(), output.fileno(), count, offset, offset), size)
+                elif strategy == 'sendfile':
+                    if not hasattr(os, 'sendfile'):
+                        raise OSError(errno.ENOSYS, "sendfile is not available")
+
+                    output.seek(0)
+                    self.__throttle_chunks__(lambda offset, count: os.sendfile(output.fileno(), input.fileno(), offset, count), size)
+                else:
+                    input.seek(0)
+                    output.seek(0)
+                    output.truncate()
+
+                    while chunk := input.read(CopyEngine.BUFFER_SIZE):
+                        self.throttle(len(chunk))
+                        output.write(chunk)
+
+                return strategy
+            except OSError as error:
+                if strategy == 'buffered':
+                    raise
+
+                if error.errno in CopyEngine.UNSUPPORTED_ERRORS:
+                    self.__unsupported.add(strategy)
+
+                # Start the next strategy from a clean slate.
+                output.truncate(0)
+
+    def __throttle_chunks__(self, copy: Callable, size: int):
+        # Without limits the kernel gets to copy as much as it can per call; with them, chunks
+        # are kept small enough for the token buckets to smooth out the transfer rate.
+        chunk_size = 1 << 30 if self.bandwidth is None and self.iops is None else CopyEngine.BUFFER_SIZE
+
+        offset = 0
+        while offset < size:
+            count = min(size - offset, chunk_size)
+            self.throttle(count)
+
+            copied = copy(offset, count)
+            if copied == 0:
+                # Backup blobs never shrink, but some filesystems report nothing copied for files
+                # they cannot handle this way; the next strategy then copies the file instead.
+                raise OSError(errno.EIO, f"copied only {offset} of {size} bytes")
+
+            offset += copied
+
+    def throttle(self, size: int):
+        # Every read or write of `size` bytes counts as one operation.
+        if self.iops is not None:
+            self.iops.take(1)
+
+        if self.bandwidth is not None and size > 0:
+            self.bandwidth.take(size)
+
+    def __initialize_worker__(self):
+        # Both settings apply per thread on Linux, so they only slow down the copy workers.
+        try:
+            if self.nice is not None:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+
+            if self.ioprio is not None:
+                CopyEngine.__set_ioprio__(*self.ioprio)
+        except (AttributeError, OSError) as error:
+            print(f"Warning! Could not lower the priority of a copy worker: {error}")
+
+    @staticmethod
+    def __set_ioprio__(io_class: int, level: int):
+        number = CopyEngine.IOPRIO_SET_SYSCALLS.get(platform.machine())
+        if number is None:
+            raise OSError(errno.ENOSYS, f"ioprio_set is not known on {platform.machine()}")
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.syscall(number, CopyEngine.IOPRIO_WHO_PROCESS, threading.get_native_id(), (io_class << 13) | level) != 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    @staticmethod
+    def parse_ioprio(ioprio: str) -> tuple:
+        io_class, _, level = ioprio.partition(':')
+        if io_class not in CopyEngine.IOPRIO_CLASSES or (level and not level.isdigit()) or int(level or 0) > 7:
+            raise ValueError(f"'{ioprio}' is not a valid I/O priority! Use idle, best-effort[:0-7] or realtime[:0-7].")
+
+        return CopyEngine.IOPRIO_CLASSES[io_class], int(level or 0)
+
+# Limits a rate, e.g. of bytes or operations per second, shared by any number of threads.
+# Callers may overdraw it and then wait until the debt is paid back, so requests larger
+# than the bucket itself are still granted, just at the configured rate.
+class TokenBucket():
+    rate: float = 0
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+
+        self.__tokens = self.capacity
+        self.__updated = monotonic()
+        self.__lock = threading.Lock()
+
+    def take(self, amount: float):
+        with self.__lock:
+            now = monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate) - amount
+            self.__updated = now
+            delay = -self.__tokens / self.rate if self.__tokens < 0 else 0
+
+        if delay > 0:
+            sleep(delay)
+
+# An append-only record, kept in the destination, of the files an extraction has completed,
+# with the size and mtime their source had. '--resume' uses it to skip those files on the next run,
+# as long as their source is unchanged.
+class ExtractionJournal():
+    FILE_NAME = '.pybackup-journal.db'
+    COMMIT_INTERVAL = 1000
+
+    path: Path = None
+
+    def __init__(self, destination: Path, backup_key: str):
+        self.path = destination / ExtractionJournal.FILE_NAME
+        self.__uncommitted = 0
+
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS Completed (fileID TEXT PRIMARY KEY, size INTEGER, mtime REAL) WITHOUT ROWID;")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS Backup (key TEXT);")
+
+        # With the 'manifest' content store layout, this maps each extracted path to its content's digest.
+        self.connection.execute("CREATE TABLE IF NOT EXISTS Stored (path TEXT PRIMARY KEY, digest TEXT) WITHOUT ROWID;")
+
+        # Every path any extraction wrote into the destination, whichever backup it came from;
+        # '--prune' never deletes anything that is not listed here.
+        self.connection.execute("CREATE TABLE IF NOT EXISTS Written (path TEXT PRIMARY KEY) WITHOUT ROWID;")
+
+        # A journal written for a different backup says nothing about this one.
+        known = self.connection.execute("SELECT key FROM Backup;").fetchone()
+        if known is None or known[0] != backup_key:
+            with self.connection:
+                self.connection.execute("DELETE FROM Completed;")
+                self.connection.execute("DELETE FROM Backup;")
+                self.connection.execute("INSERT INTO Backup VALUES (?);", (backup_key,))
+
+    def completed(self, fileIDs: list) -> dict:
+        # Maps each completed fileID to the (size, mtime) its source had when it was extracted.
+        completed = {}
+
+        # Stay below SQLite's limit on the number of bound parameters.
+        for start in range(0, len(fileIDs), 500):
+            chunk = fileIDs[start:start + 500]
+            completed.update((row[0], (row[1], row[2])) for row in self.connection.execute(
+                f"SELECT fileID, size, mtime FROM Completed WHERE fileID IN ({', '.join('?' * len(chunk))});", chunk
+            ))
+
+        return completed
+
+    def record(self, fileID: str, stat: os.stat_result):
+        self.connection.execute("INSERT OR REPLACE INTO Completed VALUES (?, ?, ?);", (fileID, stat.st_size, stat.st_mtime))
+
+        self.__uncommitted += 1
+        if self.__uncommitted >= ExtractionJournal.COMMIT_INTERVAL:
+            self.commit()
+
+    def record_digest(self, path: str, digest: str):
+        self.connection.execute("INSERT OR REPLACE INTO Stored VALUES (?, ?);", (path, digest))
+
+    def record_written(self, path: str):
+        self.connection.execute("INSERT OR IGNORE INTO Written VALUES (?);", (path,))
+
+    def written(self) -> list:
+        return [row[0] for row in self.connection.execute("SELECT path FROM Written;")]
+
+    def forget_written(self, paths: list):
+        with self.connection:
+            self.connection.executemany("DELETE FROM Written WHERE path = ?;", ((path,) for path in paths))
+
+    def commit(self):
+        self.connection.commit()
+        self.__uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
 class Extractors():
     @staticmethod
     def from_name(name: str) -> FunctionType:
@@ -93,38 +1225,186 @@ class Extractors():
     def list() -> list[str]:
         return Extractors.__mapping.keys()
 
-    def __extract_all__(backup: ParsedBackup, destination: Path):
-        backup.files.execute("SELECT * FROM Files;")
-        Extractors.__copy_files__(backup, backup.files.fetchall(), destination)
+    # The Manifest.db columns __copy_files__ reads, in the order it expects them,
+    # followed by METADATA_COLUMNS when anything needs the decoded Files.file metadata.
+    COPY_COLUMNS = ('fileID', 'relativePath')
+    METADATA_COLUMNS = ('file',)
+
+    def __extract_all__(backup: ParsedBackup, destination: Path, selection: Filter, engine: CopyEngine):
+        Extractors.__copy_files__(backup, selection, (), destination, engine)
 
-    def __extract_camera_roll__(backup: ParsedBackup, destination: Path):
+    def __extract_camera_roll__(backup: ParsedBackup, destination: Path, selection: Filter, engine: CopyEngine):
         # Photos have a few different possible extensions, though with one commonality:
         # they are stored in Media/DCIM/%APPLE/%.
 
         print("Extracting Camera Roll...")
 
-        backup.files.execute("SELECT * FROM Files WHERE relativePath like 'Media/DCIM/%APPLE/%';")
-        Extractors.__copy_files__(backup, backup.files.fetchall(), destination)
+        Extractors.__copy_files__(backup, selection, ("relativePath like 'Media/DCIM/%APPLE/%'",), destination, engine)
 
     @staticmethod
-    def __copy_files__(backup: ParsedBackup, files: list, destination: Path):
-        bar = pyprind.ProgBar(len(files))
-        for file in files:
-            fileID = file[0]
+    def __copy_files__(backup: ParsedBackup, selection: Filter, conditions: tuple, destination: Path, engine: CopyEngine):
+        # Only regular files (flags = 1) have contents in the backup; directories and symlinks are never copied.
+        # Counting them for the progress bar only reads the leading columns of each row, never the 'file' BLOBs.
+        where = selection.where('flags = 1', *conditions)
 
-            # Need to investigate this:
-            if not fileID in backup.found_files:
-            #    print(f"File {fileID} exists in Manifest.db, but not in pybackup.json!")
-                continue
+        # Sorting by fileID walks the shard directories in turn; larger batches give the per-batch
+        # inode and extent orders more files to sort.
+        order = '' if engine.order == 'manifest' else 'ORDER BY fileID'
+        batch_size = 10000 if engine.order in ('inode', 'extent') else 1000
+        columns = Extractors.COPY_COLUMNS + (Extractors.METADATA_COLUMNS if selection.predicates or engine.needs_metadata else ())
+        batches = backup.select(columns, where, selection.params, batch_size, order)
+
+        destination.mkdir(parents=True, exist_ok=True)
+        journal = ExtractionJournal(destination, backup.cache_key)
+        skipped = 0
+
+        # Failed copies clean up after themselves, but a killed run cannot.
+        Extractors.__remove_partials__(destination, engine)
+
+        def skip(resumed: bool):
+            nonlocal skipped
+            if resumed:
+                skipped += 1
+
+            bar.update()
 
-            absoluteSource = backup.path / backup.found_files[fileID]['path']
-            absoluteDestination : Path = destination / sanitize_filepath(file[2])
+        def complete(task: tuple, strategy: str, stat: os.stat_result, digest: Optional[str]):
+            path = task[2].relative_to(destination).as_posix()
 
-            os.makedirs(os.path.dirname(absoluteDestination), exist_ok=True)
+            if digest is not None and engine.store.layout == 'manifest':
+                journal.record_digest(path, digest)
+            else:
+                journal.record_written(path)
 
-            shutil.copy(absoluteSource, absoluteDestination)
+            journal.record(task[0], stat)
             bar.update()
 
+        bar = pyprind.ProgBar(backup.count(where, selection.params))
+        try:
+            results = engine.run(Extractors.__copy_tasks__(backup, selection, batches, destination, engine, journal, skip), complete)
+        finally:
+            journal.close()
+
+        if skipped > 0:
+            print(f"Skipped {skipped} files extracted by a previous run.")
+
+        print(f"Extracted {sum(results.values())} files ({', '.join(f'{count} {strategy}' if strategy in ('unchanged', 'deduplicated') else f'{count} with {strategy}' for strategy, count in results.most_common()) or 'none'}).")
+
+    @staticmethod
+    def prune(backup: ParsedBackup, destination: Path, engine: CopyEngine):
+        # Removes files that earlier extractions wrote but no extraction in this run produced, e.g. ones
+        # deleted from the device since the last sync, and then any directories that are left empty.
+        # Only paths recorded in the journal are candidates: anything else in the destination,
+        # including a content store kept there, was not written by pybackup and is left alone.
+        journal = ExtractionJournal(destination, backup.cache_key)
+        store = engine.store.path if engine.store is not None else None
+        removed = []
+
+        try:
+            for path in journal.written():
+                absolute = destination / path
+
+                if absolute in engine.expected or (store is not None and absolute.is_relative_to(store)):
+                    continue
+
+                # Something else has taken the place of the file since.
+                if absolute.is_dir() and not absolute.is_symlink():
+                    continue
+
+                CopyEngine.__remove__(absolute)
+                removed.append(path)
+
+                for directory in absolute.parents:
+                    if directory == destination:
+                        break
+
+                    try:
+                        os.rmdir(directory)
+                    except OSError:
+                        break
+
+            journal.forget_written(removed)
+        finally:
+            journal.close()
+
+        print(f"Pruned {len(removed)} files that are no longer in the backup.")
+
+    @staticmethod
+    def __remove_partials__(destination: Path, engine: CopyEngine):
+        # A killed run leaves the temporary files of the copies that were in flight behind.
+        # A content store inside the destination is left alone.
+        store = engine.store.path if engine.store is not None else None
+
+        for directory, subdirectories, files in os.walk(destination):
+            subdirectories[:] = [name for name in subdirectories if Path(directory) / name != store]
+
+            for name in files:
+                if name.endswith(CopyEngine.PARTIAL_SUFFIX):
+                    CopyEngine.__remove__(Path(directory) / name)
+
+    @staticmethod
+    def __resumable__(completed: tuple, source: Path, destination: Path, engine: CopyEngine) -> bool:
+        # A completed file is only skipped if its source has not changed since and
+        # its copy is still there; the 'manifest' store layout writes no copies.
+        source_stat = os.stat(source)
+        if completed != (source_stat.st_size, source_stat.st_mtime):
+            return False
+
+        return (engine.store is not None and engine.store.layout == 'manifest') or os.path.lexists(destination)
+
+    @staticmethod
+    def __copy_tasks__(backup: ParsedBackup, selection: Filter, batches: Iterator[list], destination: Path, engine: CopyEngine, journal: ExtractionJournal, on_skip: Callable) -> Iterator[tuple]:
+        # Rows that are not handed to the engine are reported through `on_skip`, along with whether a
+        # previous run completed them, so that together with the engine's completions every counted
+        # row is accounted for exactly once.
+        #
+        # Destination directories are created once per batch, before any of its copies start,
+        # instead of checking every file's parent directory again in the workers.
+        directories = set()
+
+        for batch in batches:
+            tasks = []
+
+            # Files a previous run completed are looked up for the whole batch at once.
+            completed = journal.completed([file[0] for file in batch]) if engine.resume else {}
+
+            # The metadata is decoded once per batch, for the filter's predicates and the engine alike.
+            metadata = FileMetadata.decode_batch(file[-1] for file in batch) if selection.predicates or engine.needs_metadata else None
+
+            for row, file in enumerate(batch):
+                if selection.predicates and not selection.matches(metadata[row]):
+                    on_skip(False)
+                    continue
+
+                fileID = file[0]
+                absoluteDestination : Path = destination / sanitize_filepath(file[1])
+
+                if engine.prune:
+                    engine.expected.add(absoluteDestination)
+
+                absoluteSource = backup.locate(fileID)
+
+                # Files listed in Manifest.db but absent from the backup are reported by '--reconcile'.
+                if absoluteSource is None:
+                    on_skip(False)
+                    continue
+
+                if fileID in completed and Extractors.__resumable__(completed[fileID], absoluteSource, absoluteDestination, engine):
+                    on_skip(True)
+                    continue
+
+                tasks.append((fileID, absoluteSource, absoluteDestination, metadata[row] if metadata is not None else None))
+
+            # With the 'manifest' store layout nothing is written to the destination tree.
+            if engine.store is not None and engine.store.layout == 'manifest':
+                directories.update(task[2].parent for task in tasks)
+
+            for directory in sorted({ task[2].parent for task in tasks } - directories):
+                os.makedirs(directory, exist_ok=True)
+                directories.add(directory)
+
+            yield from engine.sort(tasks)
+
     __mapping = {
         'all': __extract_all__,
         'camera_roll': __extract_camera_roll__
@@ -135,18 +1415,62 @@ def main(args: list[str]):
     parser = argparse.ArgumentParser(description='pybackup.py: The Python-based backup extractor for iOS devices.')
     parser.add_argument('--override', '-o', dest='override', type=bool, default=False)
     parser.add_argument('--backup', '-b', dest='path', help='The path to the iOS backup.', required=True)
-    parser.add_argument('--extract', '-e', dest='extract_type', help=f"Type of files to extract.", type=str, choices=Extractors.list())
-    parser.add_argument('--destination', '-d', dest='destination', help='The path to put the extracted files.', default='.')
+    parser.add_argument('--extract', '-e', dest='extract_type', help=f"Type of files to extract. Several types can be given at once.", type=str, nargs='+', choices=Extractors.list())
+    parser.add_argument('--filter', '-f', dest='filters', help="Only extract files matching an expression like 'domain=HomeDomain', 'domain^=AppDomain-', 'path=Media/DCIM/*', 'ext=jpg,heic', 'size>=1M' or 'mtime<2021-06-01'. May be repeated.", type=str, action='append', default=[])
+    parser.add_argument('--destination', '-d', dest='destination', help='The path to put the extracted files. Defaults to the current directory.', default=None)
+    parser.add_argument('--jobs', '-j', dest='jobs', help='The number of files to copy in parallel.', type=int, default=8)
+    parser.add_argument('--link-mode', dest='link_mode', help="How to extract files: 'copy' copies their data, 'hardlink' and 'symlink' link to them inside the backup.", type=str, choices=CopyEngine.LINK_MODES, default='copy')
+    parser.add_argument('--order', dest='order', help="The order to read files from the backup in: 'shard', 'inode' and 'extent' keep reads from spinning disks sequential.", type=str, choices=CopyEngine.ORDERS, default='manifest')
+    parser.add_argument('--resume', dest='resume', help='Skip files that a previous, interrupted extraction into the same destination already completed.', action='store_true')
+    parser.add_argument('--sync', dest='sync', help='Only extract files that are new or changed compared to the ones already in the destination. Copies are given the modification time recorded in the backup.', action='store_true')
+    parser.add_argument('--prune', dest='prune', help='After extracting, delete files that earlier extractions into the destination wrote but none of the extracted types produced. Requires --destination.', action='store_true')
+    parser.add_argument('--store', dest='store', help='Keep the contents of extracted files once in a content-addressed store at this path.', default=None)
+    parser.add_argument('--store-layout', dest='store_layout', help=f"How files in the store appear in the destination: 'hardlink' links to them, 'manifest' records their digests in {ExtractionJournal.FILE_NAME}.", type=str, choices=ContentStore.LAYOUTS, default='hardlink')
+    parser.add_argument('--preserve', '-p', dest='preserve', help="Give copied files the modification time and permissions recorded in the backup.", action='store_true')
+    parser.add_argument('--max-bandwidth', dest='max_bandwidth', help="Limit extraction to this many bytes per second, e.g. '50M'.", type=str, default=None)
+    parser.add_argument('--max-iops', dest='max_iops', help='Limit extraction to this many I/O operations per second.', type=int, default=None)
+    parser.add_argument('--nice', dest='nice', help='The niceness to run copy workers with.', type=int, default=None)
+    parser.add_argument('--ioprio', dest='ioprio', help="The I/O priority to run copy workers with on Linux: 'idle', 'best-effort[:0-7]' or 'realtime[:0-7]'.", type=str, default=None)
+    parser.add_argument('--resolver', '-r', dest='resolver', help="How to locate files: 'hash' derives each location from its fileID, 'scan' inventories the whole backup first.", type=str, choices=['hash', 'scan'], default='hash')
+    parser.add_argument('--db-profile', dest='profile', help="How to open Manifest.db: 'immutable' opens it read-only with a large page cache and mmap, 'memory' loads it into memory and indexes domain, relativePath and flags, which pays off when running several extractors, 'standard' uses SQLite's defaults.", type=str, choices=list(ParsedBackup.CONNECTION_PROFILES.keys()), default='immutable')
+    parser.add_argument('--reconcile', dest='reconcile', help='Report files missing from the backup or absent from Manifest.db. Implies --resolver scan.', action='store_true')
+    parser.add_argument('--stats', '-s', dest='stats', help='Print the number and size of files per domain, or per directory of the given domain.', type=str, nargs='?', const='', default=None)
+    parser.add_argument('--cache', '-c', dest='cache', help='The folder to keep backup indexes and statistics in. Defaults to $XDG_CACHE_HOME/pybackup.', default=None)
 
     # Ignore the first argument, it's always the name of the file.
     opts = parser.parse_args(args[1:])
+    destination = Path(opts.destination or '.').resolve()
+
+    # Pruning deletes files, so it only runs against a destination that was named explicitly
+    # and that a previous extraction left its journal in.
+    if opts.prune and opts.destination is None:
+        parser.error("--prune requires an explicit --destination.")
+
+    if opts.prune and not (destination / ExtractionJournal.FILE_NAME).is_file():
+        parser.error(f"--prune refuses to run: '{destination}' has no {ExtractionJournal.FILE_NAME} from a previous extraction.")
+
+    # Files in the store are always linked from or recorded in the destination, and their blobs are
+    # shared between paths, so neither a link mode nor restored metadata can apply to them.
+    if opts.store and opts.link_mode != 'copy':
+        parser.error("--link-mode cannot be combined with --store.")
+
+    if opts.store and opts.preserve:
+        parser.error("--preserve cannot be combined with --store.")
+
+    # A limit of zero would never let anything through, and a negative one means nothing.
+    if opts.max_bandwidth is not None and parse_size(opts.max_bandwidth) <= 0:
+        parser.error("--max-bandwidth must be greater than zero.")
+
+    if opts.max_iops is not None and opts.max_iops <= 0:
+        parser.error("--max-iops must be greater than zero.")
 
     # Verify the provided backup path
     if not os.path.isdir(opts.path):
         raise ValueError(f"The provided path '{opts.path}' does not exist or is not a folder!")
 
     # Check if the backup has already been parsed...
-    backup = ParsedBackup.from_path(Path(opts.path).resolve())
+    resolver = 'scan' if opts.reconcile else opts.resolver
+    backup = ParsedBackup.from_path(Path(opts.path).resolve(), resolver, Path(opts.cache).resolve() if opts.cache else None, opts.profile)
 
     # Otherwise, proceed with extracting the files...
     backup.pretty_print_information()
@@ -162,11 +1486,36 @@ def main(args: list[str]):
         print("Pass '--override' or '-o' to override this safety mechanism.")
         sys.exit(-1)
 
+    if opts.reconcile:
+        backup.pretty_print_reconciliation()
+
+    if opts.stats is not None:
+        backup.pretty_print_statistics(opts.stats)
+
     if getattr(opts, 'extract_type') is not None:
+        selection = Filter.parse(opts.filters)
+        store = ContentStore(Path(opts.store).resolve(), opts.store_layout) if opts.store else None
+        engine = CopyEngine(
+            max(opts.jobs, 1), link_mode=opts.link_mode, order=opts.order, resume=opts.resume, sync=opts.sync, prune=opts.prune, store=store, preserve=opts.preserve,
+            bandwidth=TokenBucket(parse_size(opts.max_bandwidth)) if opts.max_bandwidth is not None else None,
+            iops=TokenBucket(opts.max_iops) if opts.max_iops is not None else None,
+            nice=opts.nice,
+            ioprio=CopyEngine.parse_ioprio(opts.ioprio) if opts.ioprio else None
+        )
+
         try:
-            Extractors.from_name(opts.extract_type)(backup, Path(opts.destination).resolve())
-        except KeyError:
-            print(f"'{opts.extract_type}' is not a valid extraction type!")
+            for extract_type in opts.extract_type:
+                try:
+                    Extractors.from_name(extract_type)(backup, destination, selection, engine)
+                except KeyError:
+                    print(f"'{extract_type}' is not a valid extraction type!")
+        finally:
+            # Digests computed before an interruption are kept, so the next run does not hash those files again.
+            if store is not None:
+                store.close()
+
+        if opts.prune:
+            Extractors.prune(backup, destination, engine)
 
 if __name__ == '__main__':
     main(sys.argv)